@@ -7,6 +7,9 @@ from irs.management.commands import IRSCommand
 
 logger = logging.getLogger(__name__)
 
+# Read and write the archive a megabyte at a time
+CHUNK_SIZE = 1 << 20
+
 
 class Command(IRSCommand):
     help = "Download the latest IRS archive"
@@ -47,9 +50,6 @@ class Command(IRSCommand):
         self.zip_path = os.path.join(
             self.data_dir,
             'zipped_archive.zip')
-        # Where to extract the archive
-        self.extract_path = os.path.join(
-            self.data_dir)
         # Where to store the data file
         self.final_path = os.path.join(
             self.data_dir,
@@ -64,37 +64,34 @@ class Command(IRSCommand):
         """
         Download the archive from the IRS website.
         """
-        url = 'http://forms.irs.gov/app/pod/dataDownload/fullData'
-        r = requests.get(url, stream=True)
-        with open(self.zip_path, 'wb') as f:
-            # This is a big file, so we download in chunks
-            for chunk in r.iter_content(chunk_size=30720):
-                logger.debug('Downloading...')
-                f.write(chunk)
-                f.flush()
+        self.stream_to(self.url, self.zip_path)
+
+    def stream_to(self, url, path):
+        """
+        Stream a (big) file at a URL to disk in chunks.
+        """
+        with requests.Session() as session:
+            r = session.get(url, stream=True)
+            with open(path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
 
     def unzip(self):
         """
-        Unzip the archive.
+        Unzip the data file straight to its final location, rather
+        than extracting the archive's many-layered directory
+        structure and moving the file out of it.
         """
         logger.info('Unzipping archive')
         with zipfile.ZipFile(self.zip_path, 'r') as zipped_archive:
             data_file = zipped_archive.namelist()[0]
-            zipped_archive.extract(data_file, self.extract_path)
+            with zipped_archive.open(data_file) as src, \
+                    open(self.final_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
 
     def clean(self):
         """
-        Get the .txt file from within the many-layered
-        directory structure, then delete the directories.
+        Delete the zipped archive.
         """
         logger.info('Cleaning up archive')
-        shutil.move(
-            os.path.join(
-                self.data_dir,
-                'var/IRS/data/scripts/pofd/download/FullDataFile.txt'
-            ),
-            self.final_path
-        )
-
-        shutil.rmtree(os.path.join(self.data_dir, 'var'))
         os.remove(self.zip_path)
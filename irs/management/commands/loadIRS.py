@@ -1,17 +1,20 @@
 import os
 import io
 import csv
-import sys
+import mmap
 import logging
-from decimal import Decimal
-from datetime import datetime
+from contextlib import closing
+from decimal import Decimal, InvalidOperation
+from datetime import date
+from django.db import connection, models, transaction
+from django.utils.encoding import force_text
 from irs.management.commands import IRSCommand
 from irs.models import F8872, Contribution, Expenditure, Committee
 
 logger = logging.getLogger(__name__)
 
 # These are terms in the raw data that don't actually mean anything
-NULL_TERMS = [
+NULL_TERMS = frozenset([
     'N/A',
     'NOT APPLICABLE',
     'NA',
@@ -19,62 +22,204 @@ NULL_TERMS = [
     'NOT APPLICABE',
     'NOT APLICABLE',
     'N A',
-    'N-A']
-
-# Global lists of contribution and expenditure objects that we'll use
-# for our bulk create
-CONTRIBUTIONS = []
-EXPENDITURES = []
+    'N-A'])
 
 # Running list of filing ids so we don't add contributions or expenditures
-# without an associated filing
+# without an associated filing. See filing_key.
 PARSED_FILING_IDS = set()
 
+# Running list of committee ids that have already been created
+PARSED_COMMITTEE_IDS = set()
+
+# Bytes that aren't ASCII, which we strip from the raw data
+NON_ASCII = bytes(bytearray(range(128, 256)))
+
+# Characters that have to be escaped in PostgreSQL's COPY text format.
+# The backslash has to come first so we don't double-escape the others.
+COPY_ESCAPES = (
+    ('\\', '\\\\'),
+    ('\t', '\\t'),
+    ('\n', '\\n'),
+    ('\r', '\\r'))
+
+
+def copy_value(field, value):
+    """
+    Formats a value for a column in PostgreSQL's COPY text format.
+    """
+    value = field.get_db_prep_save(value, connection)
+    if value is None:
+        return '\\N'
+    value = force_text(value)
+    for char, escaped in COPY_ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def bulk_insert(model, rows):
+    """
+    Inserts a list of rows, each a dict of field attnames to values.
+    On PostgreSQL, the rows are streamed through COPY, which is much
+    faster than the multi-row INSERT generated by bulk_create. Other
+    databases fall back to bulk_create.
+    """
+    if not rows:
+        return
+    if connection.vendor != 'postgresql':
+        objects = [model(**row) for row in rows]
+        # Keep each INSERT statement to a reasonable size, without going
+        # over the number of rows the backend can take in one statement
+        batch_size = min(1000, connection.ops.bulk_batch_size(
+            model._meta.concrete_fields, objects))
+        model.objects.bulk_create(objects, batch_size=max(batch_size, 1))
+        return
+
+    fields = [
+        (f, f.get_default()) for f in model._meta.concrete_fields
+        if not isinstance(f, models.AutoField)]
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write(u'\t'.join(
+            copy_value(f, row.get(f.attname, default))
+            for f, default in fields))
+        buf.write(u'\n')
+    buf.seek(0)
+
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join(connection.ops.quote_name(f.column) for f, _ in fields))
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, buf)
+
+
+class ChunkedInsert(object):
+    """
+    Context manager that collects rows for a model and inserts
+    them in chunks. Whatever is left over is inserted on exit.
+    Rows are kept as plain dicts rather than model instances,
+    which are much heavier, until they are inserted.
+    """
+
+    def __init__(self, model, chunk_size=5000):
+        self.model = model
+        self.chunk_size = chunk_size
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't save a partial chunk if the load blew up
+        if exc_type is None:
+            self.flush()
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        bulk_insert(self.model, self.rows)
+        self.rows = []
+
+
+def filing_key(form_id_number):
+    """
+    Returns the key used to track a filing in PARSED_FILING_IDS.
+    Filing ids are numeric, so we store them as ints, which take
+    up much less memory than strings. Ids with leading zeros are
+    kept as strings so they can't match a different filing.
+    """
+    if (form_id_number and form_id_number.isdigit() and
+            not form_id_number.startswith('0')):
+        return int(form_id_number)
+    return form_id_number
+
+
+def parse_date(cell):
+    """
+    Parses a YYYYMMDD date. Slicing is much cheaper than strptime.
+    """
+    if len(cell) != 8:
+        return None
+    try:
+        return date(int(cell[:4]), int(cell[4:6]), int(cell[6:]))
+    except ValueError:
+        return None
+
+
+def parse_int(cell):
+    """
+    Parses an integer. Numeric cells are often blank, so we check
+    for that up front rather than letting the conversion raise.
+    """
+    if not cell:
+        return None
+    try:
+        return int(cell)
+    except ValueError:
+        return None
+
+
+def parse_decimal(cell):
+    """
+    Parses a dollar amount.
+    """
+    if not cell:
+        return None
+    try:
+        return Decimal(cell)
+    except InvalidOperation:
+        return None
+
+
+def parse_text(cell):
+    """
+    Uppercases and truncates a text cell, treating
+    meaningless terms as null.
+    """
+    # Truncate first so we only uppercase what we keep. The data
+    # is all ASCII by now, so uppercasing can't change the length.
+    cell = cell[:50].upper()
+
+    if not cell or cell in NULL_TERMS:
+        return None
+
+    return cell
+
+
+# Functions to clean each type of field in the mappings. Any other
+# field type is treated as text.
+CELL_PARSERS = {
+    'D': parse_date,
+    'I': parse_int,
+    'N': parse_decimal,
+}
+
 
 class RowParser:
     """
     Takes a row from the raw data and a mapping of field
     positions to field names in order to clean and save the
-    row to the database.
+    row to the database. Contributions and expenditures are
+    added to the given ChunkedInsert buffer.
     """
 
-    def __init__(self, form_type, mapping, row):
+    def __init__(self, form_type, mapping, row, buffer=None):
+        if form_type in ('A', 'B') and buffer is None:
+            raise ValueError(
+                'Schedule A and B rows need a ChunkedInsert buffer')
+
         self.form_type = form_type
         self.mapping = mapping
         self.row = row
+        self.buffer = buffer
         self.parsed_row = {}
 
         self.parse_row()
         self.create_object()
 
-    def clean_cell(self, cell, cell_type):
-        """
-        Uses the type of field (from the mapping) to
-        determine how to clean and format the cell.
-        """
-        try:
-            # Get rid of non-ASCII characters
-            cell = cell.encode('ascii', 'ignore').decode()
-            if cell_type == 'D':
-                cell = datetime.strptime(cell, '%Y%m%d')
-            elif cell_type == 'I':
-                cell = int(cell)
-            elif cell_type == 'N':
-                cell = Decimal(cell)
-            else:
-                cell = cell.upper()
-
-                if len(cell) > 50:
-                    cell = cell[0:50]
-
-                if not cell or cell in NULL_TERMS:
-                    cell = None
-
-        except:
-            cell = None
-
-        return cell
-
     def parse_row(self):
         """
         Parses a row, cell-by-cell, returning a dict of field names
@@ -82,46 +227,38 @@ class RowParser:
         """
         fields = self.mapping
         for i, cell in enumerate(self.row[0:len(fields)]):
-            field_name, field_type = fields[str(i)]
-            parsed_cell = self.clean_cell(cell, field_type)
-            self.parsed_row[field_name] = parsed_cell
+            field_name, field_type = fields[i]
+            parse_cell = CELL_PARSERS.get(field_type, parse_text)
+            self.parsed_row[field_name] = parse_cell(cell)
 
     def create_object(self):
-        if self.form_type == 'A':
-            contribution = Contribution(**self.parsed_row)
-
-            # If there's no filing in the database for this contribution
-            if contribution.form_id_number not in PARSED_FILING_IDS:
-                # Skip this contribution
-                return
-
-            contribution.filing_id = contribution.form_id_number
-            contribution.committee_id = contribution.EIN
-
-            CONTRIBUTIONS.append(contribution)
-        elif self.form_type == 'B':
-            expenditure = Expenditure(**self.parsed_row)
+        if self.form_type in ('A', 'B'):
+            # A contribution or expenditure
+            row = self.parsed_row
 
-            # If there's no filing in the database for this expenditure
-            if expenditure.form_id_number not in PARSED_FILING_IDS:
-                # Skip this expenditure
+            # If there's no filing in the database for this row
+            if filing_key(row.get('form_id_number')) not in PARSED_FILING_IDS:
+                # Skip this row
                 return
 
-            expenditure.filing_id = expenditure.form_id_number
-            expenditure.committee_id = expenditure.EIN
+            row['filing_id'] = row['form_id_number']
+            row['committee_id'] = row.get('EIN')
 
-            EXPENDITURES.append(expenditure)
+            self.buffer.append(row)
 
         elif self.form_type == '2':
             filing = F8872(**self.parsed_row)
-            PARSED_FILING_IDS.add(filing.form_id_number)
+            PARSED_FILING_IDS.add(filing_key(filing.form_id_number))
             logger.debug('Parsing filing {}'.format(filing.form_id_number))
-            committee, created = Committee.objects.get_or_create(
-                EIN=filing.EIN)
-            if created:
-                committee.name = filing.organization_name
-                committee.save()
-            filing.committee = committee
+
+            # Only create each committee the first time we see it,
+            # rather than querying for it on every filing
+            if filing.EIN not in PARSED_COMMITTEE_IDS:
+                Committee.objects.create(
+                    EIN=filing.EIN,
+                    name=filing.organization_name)
+                PARSED_COMMITTEE_IDS.add(filing.EIN)
+            filing.committee_id = filing.EIN
 
             filing.save()
 
@@ -180,66 +317,99 @@ class Command(IRSCommand):
         if os.stat(self.final_path).st_size == 0:
             raise Exception('The file to be loaded is empty!')
 
+        # Load everything in one transaction, rather than committing
+        # after every statement
+        with transaction.atomic():
+            self.flush_database()
+            self.parse_archive()
+            self.resolve_amendments()
+
+    def flush_database(self):
+        """
+        Delete any previously loaded filings.
+        """
         logger.info('Flushing database')
         F8872.objects.all().delete()
         Contribution.objects.all().delete()
         Expenditure.objects.all().delete()
         Committee.objects.all().delete()
 
+        PARSED_FILING_IDS.clear()
+        PARSED_COMMITTEE_IDS.clear()
+
+    def parse_archive(self):
+        """
+        Parse the data file row by row and save the filings,
+        contributions and expenditures.
+        """
         logger.info('Parsing archive')
         self.build_mappings()
 
-        global CONTRIBUTIONS
-        global EXPENDITURES
-
-        with io.open(self.final_path, 'rU', encoding='ISO-8859-1') as raw_file:
-            # Deal with badly encoded files in Python 2
-            if sys.version_info < (3, 0):
-                def reencode(file):
-                    for line in file:
-                        yield line.decode('ISO-8859-1').encode('utf-8')
-
-                reader = csv.reader(reencode(open(self.final_path, 'rU')),
-                                    delimiter='|')
-            else:
-                reader = csv.reader(raw_file, delimiter='|')
-
-            for row in reader:
-                # Use bulk_create to save contributions and expenditures
-                # 5000 at a time
-                if len(CONTRIBUTIONS) > 5000:
-                    Contribution.objects.bulk_create(CONTRIBUTIONS)
-                    CONTRIBUTIONS = []
-                if len(EXPENDITURES) > 5000:
-                    Expenditure.objects.bulk_create(EXPENDITURES)
-                    EXPENDITURES = []
-
-                try:
-                    form_type = row[0]
-                    if form_type == '2':
-                        RowParser(form_type, self.mappings['F8872'], row)
-                    elif form_type == 'A':
-                        RowParser(form_type, self.mappings['sa'], row)
-                    elif form_type == 'B':
-                        RowParser(form_type, self.mappings['sb'], row)
-                except IndexError:
-                    pass
-
-            # Save the remaining contributions and expenditures
-            Contribution.objects.bulk_create(CONTRIBUTIONS)
-            Expenditure.objects.bulk_create(EXPENDITURES)
-
+        with open(self.final_path, 'rb') as raw_file, \
+                closing(mmap.mmap(raw_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)) as data:
+            # We read the file front to back, so let the kernel read
+            # ahead more aggressively (only available in Python 3.8+)
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+
+            # The data file is pipe-delimited and never quoted, so a plain
+            # split is all we need, and much cheaper than the csv module.
+            # Non-ASCII characters are dropped from the whole line at
+            # once, which leaves bytes we can decode as plain ASCII.
+            reader = (
+                line.translate(None, NON_ASCII).decode('ascii')
+                .rstrip('\r\n').split('|')
+                for line in iter(data.readline, b''))
+
+            # Save contributions and expenditures 5000 at a time
+            with ChunkedInsert(Contribution) as contributions, \
+                    ChunkedInsert(Expenditure) as expenditures:
+                for row in reader:
+                    try:
+                        form_type = row[0]
+                        if form_type == '2':
+                            RowParser(form_type, self.mappings['F8872'], row)
+                        elif form_type == 'A':
+                            RowParser(form_type, self.mappings['sa'], row,
+                                      contributions)
+                        elif form_type == 'B':
+                            RowParser(form_type, self.mappings['sb'], row,
+                                      expenditures)
+                    except IndexError:
+                        pass
+
+    def resolve_amendments(self):
+        """
+        Mark filings that were later amended, and link them to
+        the filing that amended them.
+        """
         logger.info('Resolving amendments')
-        for filing in F8872.objects.filter(amended_report_indicator=1):
-            previous_filings = F8872.objects.filter(
-                committee_id=filing.EIN,
-                begin_date=filing.begin_date,
-                end_date=filing.end_date,
-                form_id_number__lt=filing.form_id_number)
-
-            previous_filings.update(
-                is_amended=True,
-                amended_by_id=filing.form_id_number)
+        # A filing is amended by any later filing from the same committee
+        # that covers the same period and is marked as an amendment.
+        # We do this with a single UPDATE rather than a query per filing.
+        amendments = """
+            SELECT {select} FROM {table} amendment
+            WHERE amendment.amended_report_indicator = 1
+            AND amendment.committee_id = {table}.committee_id
+            AND amendment.begin_date = {table}.begin_date
+            AND amendment.end_date = {table}.end_date
+            AND amendment.form_id_number > {table}.form_id_number
+        """
+        table = connection.ops.quote_name(F8872._meta.db_table)
+        sql = """
+            UPDATE {table}
+            SET is_amended = %s, amended_by_id = ({amended_by})
+            WHERE EXISTS ({exists})
+        """.format(
+            table=table,
+            amended_by=amendments.format(
+                select='MIN(amendment.form_id_number)',
+                table=table),
+            exists=amendments.format(select='1', table=table))
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [True])
 
     def build_mappings(self):
         """
@@ -255,12 +425,10 @@ class Command(IRSCommand):
                         os.path.dirname(__file__))),
                 'mappings',
                 '{}.csv'.format(record_type))
-            mapping = {}
             with open(path, 'r') as csvfile:
                 reader = csv.DictReader(csvfile)
-                for row in reader:
-                    mapping[row['position']] = (
-                        row['model_name'],
-                        row['field_type'])
+                entries = sorted(reader, key=lambda row: int(row['position']))
 
-            self.mappings[record_type] = mapping
+            # A tuple of (name, type) pairs, indexed by position
+            self.mappings[record_type] = tuple(
+                (row['model_name'], row['field_type']) for row in entries)
@@ -343,6 +343,10 @@ class F8872(models.Model):
 
     class Meta:
         ordering = ['-end_date', '-form_id_number']
+        # Used when resolving amendments
+        index_together = [
+            ['committee', 'begin_date', 'end_date', 'form_id_number'],
+        ]
 
     def __unicode__(self):
         return self.form_id_number
@@ -1,6 +1,14 @@
-from django.test import TestCase
+from datetime import date
+from decimal import Decimal
+from unittest import skipIf
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
 from django.core.management import call_command
 from irs.models import F8872, Contribution, Expenditure, Committee
+from irs.management.commands import loadIRS
+from irs.management.commands.loadIRS import (
+    parse_date, parse_int, parse_decimal, parse_text,
+    copy_value, bulk_insert)
 
 
 class IRSFilingsTest(TestCase):
@@ -76,3 +84,126 @@ class IRSFilingsTest(TestCase):
     @classmethod
     def tearDownClass(cls):
         pass
+
+
+class CellParserTest(SimpleTestCase):
+
+    def test_parse_cells(self):
+        """
+        Check that cells are cleaned according to their type,
+        and that bad values become nulls.
+        """
+        self.assertEqual(parse_date('20150630'), date(2015, 6, 30))
+        self.assertIsNone(parse_date('20150231'))
+        self.assertIsNone(parse_date(''))
+        self.assertEqual(parse_int('1'), 1)
+        self.assertIsNone(parse_int(''))
+        self.assertEqual(parse_decimal('5000.50'), Decimal('5000.50'))
+        self.assertIsNone(parse_decimal('N/A'))
+        self.assertEqual(parse_text('Washington'), 'WASHINGTON')
+        self.assertEqual(len(parse_text('X' * 60)), 50)
+        self.assertIsNone(parse_text('n/a'))
+        self.assertIsNone(parse_text(''))
+
+
+try:
+    from django.db.backends.postgresql.operations import (
+        DatabaseOperations as PostgresOperations)
+except ImportError:
+    try:
+        # Django 1.8
+        from django.db.backends.postgresql_psycopg2.operations import (
+            DatabaseOperations as PostgresOperations)
+    except ImportError:
+        # psycopg2 isn't installed
+        PostgresOperations = None
+
+
+class StubCursor(object):
+    """
+    Records what would have been sent to PostgreSQL's COPY.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def copy_expert(self, sql, buf):
+        self.sql = sql
+        self.data = buf.read()
+
+
+class StubConnection(object):
+    """
+    Looks enough like a PostgreSQL connection to take the COPY path,
+    using the PostgreSQL backend's operations to prepare values.
+    """
+    vendor = 'postgresql'
+
+    def __init__(self):
+        self.ops = PostgresOperations(self)
+        self.stub_cursor = StubCursor()
+
+    def cursor(self):
+        return self.stub_cursor
+
+
+@skipIf(PostgresOperations is None, 'psycopg2 is not installed')
+class CopyTest(SimpleTestCase):
+
+    def setUp(self):
+        self.connection = StubConnection()
+        loadIRS.connection = self.connection
+
+    def tearDown(self):
+        loadIRS.connection = connection
+
+    def test_copy_value(self):
+        """
+        Check that values are formatted and escaped for COPY.
+        """
+        name = Contribution._meta.get_field('contributor_name')
+        amount = Contribution._meta.get_field('contribution_amount')
+        self.assertEqual(
+            copy_value(name, 'A\\B\tC\nD'),
+            'A\\\\B\\tC\\nD')
+        self.assertEqual(copy_value(name, None), '\\N')
+        self.assertEqual(copy_value(amount, Decimal('5.5')), '5.50')
+
+    def test_bulk_insert(self):
+        """
+        Check the columns and rows that are sent to COPY, including
+        defaults for columns missing from a row.
+        """
+        bulk_insert(Committee, [
+            {'EIN': '123456789', 'name': 'A\tB'},
+            {'EIN': '987654321'}])
+        cursor = self.connection.stub_cursor
+        self.assertEqual(
+            cursor.sql,
+            'COPY "irs_committee" ("EIN", "name") FROM STDIN')
+        self.assertEqual(
+            cursor.data,
+            '123456789\tA\\tB\n987654321\t\n')
+
+    def test_bulk_insert_skips_auto_field(self):
+        """
+        Check that the auto-incrementing id is left to the database
+        and unmapped nullable columns are sent as nulls.
+        """
+        bulk_insert(Contribution, [{'EIN': '123456789'}])
+        cursor = self.connection.stub_cursor
+        columns = [
+            f.column for f in Contribution._meta.concrete_fields
+            if f.column != 'id']
+        self.assertEqual(
+            cursor.sql,
+            'COPY "irs_contribution" ({}) FROM STDIN'.format(
+                ', '.join('"{}"'.format(c) for c in columns)))
+        values = cursor.data.rstrip('\n').split('\t')
+        self.assertEqual(len(values), len(columns))
+        self.assertEqual(values[columns.index('EIN')], '123456789')
+        self.assertEqual(
+            values[columns.index('contributor_name')], '\\N')